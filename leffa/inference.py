@@ -26,9 +26,37 @@ class LeffaInference(object):
             self.model.load_state_dict(torch.load(ckpt_path, map_location="cpu"))
         self.model = self.model.to(self.device)
         self.model.eval()
+        # Inference only: dropping grad tracking frees the autograd
+        # bookkeeping on every forward and keeps fullgraph compilation
+        # clean.
+        self.model.requires_grad_(False)
+
+        if self.device != "cpu":
+            self.move_scheduler_to_device(self.model.noise_scheduler)
 
         self.pipe = LeffaPipeline(model=self.model)
 
+    def move_scheduler_to_device(self, scheduler) -> None:
+        # Diffusers schedulers do their per-step sigma/timestep lookups on
+        # CPU tensors, which inserts a CPU-GPU sync into every denoising
+        # step and breaks CUDA graph capture. Keep those on the inference
+        # device across set_timesteps calls. The init-time schedule
+        # tensors (alphas_cumprod, lambda_t, ...) must stay on CPU:
+        # set_timesteps itself round-trips them through numpy.
+        step_tensor_names = ("timesteps", "sigmas")
+
+        original_set_timesteps = scheduler.set_timesteps
+
+        def set_timesteps(*args, **kwargs):
+            outputs = original_set_timesteps(*args, **kwargs)
+            for name in step_tensor_names:
+                value = getattr(scheduler, name, None)
+                if isinstance(value, torch.Tensor):
+                    setattr(scheduler, name, value.to(self.device))
+            return outputs
+
+        scheduler.set_timesteps = set_timesteps
+
     def to_gpu(self, data: Dict[str, Any]) -> Dict[str, Any]:
         for k, v in data.items():
             if isinstance(v, torch.Tensor):
@@ -1,4 +1,5 @@
 import inspect
+import os
 
 import numpy as np
 import torch
@@ -8,6 +9,44 @@ import tqdm
 from PIL import Image, ImageFilter
 
 
+class CudaGraphStep(object):
+    """
+    Captures one denoising step (reference UNet + generative UNet) as a
+    CUDA graph and replays it on later steps, copying the per-step latent
+    and timestep into static buffers. Valid because shapes are static
+    across steps; everything else (masked image, densepose, reference
+    latents) is constant for the whole diffusion call and baked into the
+    capture.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.graph = None
+        self.static_latent = None
+        self.static_t = None
+        self.static_out = None
+
+    def __call__(self, latent_model_input, t):
+        if self.graph is None:
+            # Warm up eagerly on a side stream, then capture.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self.fn(latent_model_input, t)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.static_latent = latent_model_input.clone()
+            self.static_t = t.clone()
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_out = self.fn(self.static_latent, self.static_t)
+            return self.static_out.clone()
+        self.static_latent.copy_(latent_model_input)
+        self.static_t.copy_(t)
+        self.graph.replay()
+        return self.static_out.clone()
+
+
 class LeffaPipeline(object):
     def __init__(
         self,
@@ -63,8 +102,10 @@ class LeffaPipeline(object):
         densepose = densepose.to(device=self.vae.device, dtype=self.vae.dtype)
         masked_image = src_image * (mask < 0.5)
 
-        # 1. VAE encoding
-        with torch.no_grad():
+        # 1. VAE encoding (outside autocast, in the VAE's own dtype: the
+        # VAE may deliberately be kept in fp32, since fp16 overflows the
+        # SDXL-inpainting VAE)
+        with torch.no_grad(), torch.autocast(masked_image.device.type, enabled=False):
             # src_image_latent = self.vae.encode(src_image).latent_dist.sample()
             masked_image_latent = self.vae.encode(
                 masked_image).latent_dist.sample()
@@ -100,6 +141,33 @@ class LeffaPipeline(object):
             len(timesteps) - num_inference_steps * self.noise_scheduler.order
         )
 
+        def denoise_step(latent_model_input, t):
+            down, reference_features = self.unet_encoder(
+                ref_image_latent, t, encoder_hidden_states=None, return_dict=False
+            )
+            reference_features = list(reference_features)
+
+            # predict the noise residual
+            noise_pred = self.unet(
+                latent_model_input,
+                t,
+                encoder_hidden_states=None,
+                cross_attention_kwargs=None,
+                added_cond_kwargs=None,
+                reference_features=reference_features,
+                return_dict=False,
+            )[0]
+            return noise_pred
+
+        # Manual CUDA graph replay of the per-step UNet block; opt-in via
+        # LEFFA_CUDA_GRAPH=1. Leave it off when the UNets are compiled
+        # with mode="reduce-overhead", which already captures graphs.
+        if (
+            os.environ.get("LEFFA_CUDA_GRAPH", "0") == "1"
+            and torch.cuda.is_available()
+        ):
+            denoise_step = CudaGraphStep(denoise_step)
+
         with tqdm.tqdm(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 # expand the latent if we are doing classifier free guidance
@@ -122,21 +190,7 @@ class LeffaPipeline(object):
                     dim=1,
                 )
 
-                down, reference_features = self.unet_encoder(
-                    ref_image_latent, t, encoder_hidden_states=None, return_dict=False
-                )
-                reference_features = list(reference_features)
-
-                # predict the noise residual
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=None,
-                    cross_attention_kwargs=None,
-                    added_cond_kwargs=None,
-                    reference_features=reference_features,
-                    return_dict=False,
-                )[0]
+                noise_pred = denoise_step(latent_model_input, t)
                 # perform guidance
                 if do_classifier_free_guidance:
                     noise_pred_uncond, noise_pred_cond = noise_pred.chunk(2)
@@ -183,7 +237,10 @@ class LeffaPipeline(object):
 
 def latent_to_image(latent, vae):
     latent = 1 / vae.config.scaling_factor * latent
-    image = vae.decode(latent).sample
+    # Decode outside autocast in the VAE's own dtype (see the encoding
+    # note in LeffaPipeline.__call__).
+    with torch.autocast(latent.device.type, enabled=False):
+        image = vae.decode(latent.to(vae.dtype)).sample
     image = (image / 2 + 0.5).clamp(0, 1)
     # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
     image = image.cpu().permute(0, 2, 3, 1).float().numpy()
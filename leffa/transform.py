@@ -51,11 +51,31 @@ class LeffaTransform(nn.Module):
                 src_image, self.height, self.width)[0]
             ref_image = self.vae_processor.preprocess(
                 ref_image, self.height, self.width)[0]
-            mask = self.mask_processor.preprocess(
-                mask, self.height, self.width)[0]
+            if isinstance(mask, torch.Tensor):
+                # uint8 HxW tensor (e.g. straight from AutoMasker);
+                # normalize and resize without a PIL round-trip.
+                mask = mask.to(dtype=torch.float32) / 255.0
+                mask = torch.nn.functional.interpolate(
+                    mask[None, None, :, :],
+                    size=(self.height, self.width),
+                    mode="nearest",
+                )[0]
+            else:
+                mask = self.mask_processor.preprocess(
+                    mask, self.height, self.width)[0]
             if self.dataset in ["pose_transfer"]:
                 densepose = densepose.resize(
                     (self.width, self.height), Image.NEAREST)
+            elif isinstance(densepose, torch.Tensor):
+                # uint8 HxWxC tensor; same normalization as the
+                # vae_processor path.
+                densepose = densepose.permute(2, 0, 1).to(
+                    dtype=torch.float32) / 127.5 - 1.0
+                densepose = torch.nn.functional.interpolate(
+                    densepose[None],
+                    size=(self.height, self.width),
+                    mode="nearest",
+                )[0]
             else:
                 densepose = self.vae_processor.preprocess(
                     densepose, self.height, self.width
@@ -74,10 +94,17 @@ class LeffaTransform(nn.Module):
             mask_list.append(mask)
             densepose_list.append(densepose)
 
-        src_image = torch.cat(src_image_list, dim=0)
-        ref_image = torch.cat(ref_image_list, dim=0)
-        mask = torch.cat(mask_list, dim=0)
-        densepose = torch.cat(densepose_list, dim=0)
+        # Items in a micro-batch can live on different devices (e.g. a
+        # CUDA mask from AutoMasker next to a CPU one from the example
+        # cache); align each list before concatenating.
+        def cat_on_common_device(tensors):
+            device = tensors[0].device
+            return torch.cat([t.to(device) for t in tensors], dim=0)
+
+        src_image = cat_on_common_device(src_image_list)
+        ref_image = cat_on_common_device(ref_image_list)
+        mask = cat_on_common_device(mask_list)
+        densepose = cat_on_common_device(densepose_list)
 
         batch["src_image"] = src_image
         batch["ref_image"] = ref_image
@@ -33,8 +33,9 @@ class DensePosePredictor(object):
         outputs = self.extractor(outputs)
         return outputs
 
-    def predict_iuv(self, image):
-        outputs = self.predict(image)
+    def predict_iuv(self, image, outputs=None):
+        if outputs is None:
+            outputs = self.predict(image)
 
         img_i = outputs[0][0].labels[None, ...]
         img_uv = outputs[0][0].uv
@@ -54,14 +55,23 @@ class DensePosePredictor(object):
 
         return image_iuv
 
-    def predict_seg(self, image):
-        outputs = self.predict(image)
+    def predict_seg(self, image, outputs=None):
+        if outputs is None:
+            outputs = self.predict(image)
 
         image_seg = np.zeros(image.shape, dtype=image.dtype)
         self.visualizer.visualize(image_seg, outputs)
 
         return image_seg
 
+    def predict_both(self, image):
+        # The IUV and segmentation heads share the backbone/RPN forward,
+        # so run the detector once and derive both maps from its outputs.
+        outputs = self.predict(image)
+        image_iuv = self.predict_iuv(image, outputs)
+        image_seg = self.predict_seg(image, outputs)
+        return image_iuv, image_seg
+
 
 if __name__ == "__main__":
     import sys
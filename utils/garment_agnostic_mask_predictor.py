@@ -208,6 +208,8 @@ class AutoMasker:
         torch.manual_seed(0)
         torch.cuda.manual_seed(0)
 
+        self.device = device
+
         self.densepose_processor = DensePose(densepose_path, device)
         self.schp_processor_atr = SCHP(
             ckpt_path=os.path.join(schp_path, "exp-schp-201908301523-atr.pth"),
@@ -370,6 +372,7 @@ class AutoMasker:
         self,
         image: Union[str, Image.Image],
         mask_type: str = "upper",
+        return_tensor: bool = False,
     ):
         assert mask_type in [
             "upper",
@@ -385,6 +388,10 @@ class AutoMasker:
             preprocess_results["schp_atr"],
             part=mask_type,
         )
+        if return_tensor:
+            # uint8 HxW tensor on the predictor's device, so downstream
+            # consumers can stay tensor-native without a PIL round-trip.
+            mask = torch.from_numpy(np.asarray(mask)).to(self.device)
         return {
             "mask": mask,
             "densepose": preprocess_results["densepose"],